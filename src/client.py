@@ -1,24 +1,385 @@
 import argparse
+import ast
 import asyncio
 import base64
+from collections import OrderedDict
 from contextlib import AsyncExitStack
 from datetime import timedelta
+from functools import lru_cache
+import hashlib
 from io import BytesIO
 import json
 import logging
 import os
-from typing import Any, Dict, Optional
+import random
+import re
+import sys
+import textwrap
+from typing import Any, Awaitable, Callable, Dict, Optional
 
+import httpx
 from mcp import ClientSession
 from mcp.types import ImageContent
 from langchain_ollama import ChatOllama
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from langchain_core.messages import HumanMessage, AIMessage, AIMessageChunk, SystemMessage, ToolMessage
 from mcp.client.streamable_http import streamablehttp_client
+from mcp.shared._httpx_utils import MCP_DEFAULT_SSE_READ_TIMEOUT, MCP_DEFAULT_TIMEOUT
 from PIL import Image
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+try:
+    import ahocorasick
+except ImportError:
+    # pyahocorasick is optional; tool names are then searched for one at a time
+    ahocorasick = None
+
+try:
+    import orjson
+except ImportError:
+    # orjson is optional; fall back to the standard library json module
+    orjson = None
+
+# Configure logging, falling back to INFO for an unknown LOG_LEVEL
+_log_level = os.environ.get("LOG_LEVEL", "INFO").upper()
+_valid_log_level = isinstance(logging.getLevelName(_log_level), int)
+logging.basicConfig(level=_log_level if _valid_log_level else logging.INFO)
 logger = logging.getLogger("ollama-browser-session")
+if not _valid_log_level:
+    logger.warning("Unknown LOG_LEVEL %r, using INFO", _log_level)
+
+# Patterns used to pull actions out of Ollama's responses, compiled once at import
+_JSON_FENCE_OBJECT_RE = re.compile(r'(?<=```json).*?(?=})', re.S)
+_URL_RE = re.compile(r'https?://[^\s"\']+')
+_XY_RE = re.compile(r'x":\s*([^,]*),.*\s*?"y":\s*([^,]*)')
+_DIGITS_RE = re.compile(r'\d+')
+_SELECTOR_RE = re.compile(r'(?<="selector": )\".+\"')
+_DIRECTION_RE = re.compile(r'(?<="direction": )\".+\"')
+_EXTRACT_RE = re.compile(r'(?:)\[[\S\s]*\]')
+# Markers of the action blocks _parse_action looks for; a raw block is a bare JSON object
+_ACTION_MARKERS = (("json", "```json"), ("python", "```python"), ("raw", "{"))
+_JSON_DECODER = json.JSONDecoder()
+
+SYSTEM_PROMPT = textwrap.dedent("""
+    Use the browser automation tools and open required websites for extracting relevant information, and execute tasks.
+    Every step need to be well thought out and decide on the next procedure to be taken to execute the task.
+    Independent actions can be requested together as a JSON object with a 'steps' list of 'tool' and 'parameters' objects.
+    """).strip()
+
+# Pseudo-tool offered to Ollama next to the MCP tools so it can signal the end of the task
+TASK_COMPLETE_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "task_complete",
+        "description": "Call this once the task has been completed.",
+        "parameters": {"type": "object", "properties": {}},
+    },
+}
+
+# System prompts already built, keyed by server URL and tool-set fingerprint, so a
+# reconnect to the same tools reuses the exact same prompt string
+_SYSTEM_PROMPTS: dict[tuple[str, tuple[tuple[str, str], ...]], str] = {}
+
+# Maximum number of Ollama replies kept in the response cache
+_LLM_CACHE_SIZE = 256
+# Number of tools from which the Aho-Corasick automaton is used to find tool mentions
+_AHOCORASICK_MIN_TOOLS = 50
+
+RETRY_PROMPT = "Please provide a specific action to take using one of the available tools. Format your response as a JSON object with 'tool' and 'parameters' fields."
+# Consecutive replies without a usable action before the task is abandoned
+MAX_RETRIES = 3
+TIMEOUT_PROMPT = "The previous attempt timed out. Reply with only the next action, without further explanation."
+
+
+# Connection pool for the MCP transport: the httpx defaults, except that idle connections are
+# kept alive long enough to be reused after an Ollama turn (httpx closes them after 5 seconds)
+_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60)
+
+def _create_http_client(
+    headers: dict[str, str] | None = None,
+    timeout: httpx.Timeout | None = None,
+    auth: httpx.Auth | None = None,
+) -> httpx.AsyncClient:
+    """httpx client factory for the MCP transport, keeping the SDK's timeouts and redirect handling"""
+    if timeout is None:
+        timeout = httpx.Timeout(MCP_DEFAULT_TIMEOUT, read=MCP_DEFAULT_SSE_READ_TIMEOUT)
+    return httpx.AsyncClient(headers=headers, timeout=timeout, auth=auth, limits=_HTTP_LIMITS)
+
+def _loads(text: str) -> Any:
+    """Parse JSON text, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+def _dumps(obj: Any, sort_keys: bool = False, default: Callable[[Any], Any] | None = None) -> bytes:
+    """Serialize obj as compact UTF-8 JSON, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(obj, sort_keys=sort_keys, default=default, separators=(",", ":"), ensure_ascii=False).encode()
+
+def _dumps_pretty(obj: Any) -> str:
+    """Serialize obj as indented JSON for display, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(obj, indent=2)
+
+class _LazyJson:
+    """Log argument that is only serialized when the record is actually emitted"""
+    __slots__ = ("obj",)
+
+    def __init__(self, obj: Any):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return _dumps_pretty(self.obj)
+
+def _normalize_action(action: Any) -> Dict[str, Any] | None:
+    """Convert the action shapes Ollama produces into a dict with 'tool' and 'parameters'"""
+    if isinstance(action, dict):
+        if "name" in action and "arguments" in action:
+            return {
+                "tool":action["name"],
+                "parameters":action["arguments"]
+            }
+        elif "tool" in action and "parameters" in action:
+            return action
+        elif "tool" in action and "inputSchema" in action:
+            return {
+                "tool":action["tool"],
+                "parameters": action["inputSchema"]
+            }
+    return None
+
+def _make_step(tool_name: str, parameters: Dict[str, Any], session_id: str | None) -> Dict[str, Any]:
+    """Build an action, filling in the browser session ID for the tools that act on it"""
+    if session_id and tool_name not in ("launch_browser", "task_complete"):
+        return {"tool": tool_name, "parameters": {**parameters, "session_id": session_id}}
+    return {"tool": tool_name, "parameters": dict(parameters)}
+
+def _show_image(encoded_data: str) -> None:
+    """Decode a base64 screenshot and open it in the system image viewer"""
+    Image.open(BytesIO(base64.b64decode(encoded_data))).show()
+
+def _approx_token_count(message: SystemMessage|HumanMessage|AIMessage|ToolMessage) -> int:
+    """Cheap token estimate for a message, assuming about four characters per token"""
+    return len(message.content) // 4
+
+def _parse_python_call(text: str, start: int) -> Dict[str, Any] | None:
+    """Parse the first `tool(key=value, ...)` call in text after start"""
+    open_index = text.find("(", start)
+    if open_index == -1:
+        return None
+    name = text[start:open_index].split()
+    if not name:
+        return None
+
+    # Find the matching parenthesis, ignoring any inside quoted values
+    depth = 0
+    quote = None
+    for index in range(open_index, len(text)):
+        char = text[index]
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                break
+    else:
+        return None
+
+    # Let Python parse the arguments, so that quoted values may contain '=' and ','
+    try:
+        call: ast.Call = ast.parse("call" + text[open_index:index + 1], mode="eval").body # type: ignore
+        params = {keyword.arg: ast.literal_eval(keyword.value) for keyword in call.keywords if keyword.arg}
+    except (SyntaxError, ValueError):
+        return None
+    return {"tool": name[-1], "parameters": params}
+
+def _scan(response_text: str) -> list[tuple[int, str]]:
+    """Return the offsets and kinds of the candidate action blocks in response_text, earliest first"""
+    return sorted((index, kind) for kind, marker in _ACTION_MARKERS if (index := response_text.find(marker)) != -1)
+
+
+@lru_cache(maxsize=32)
+def _tool_pattern(tool_names: tuple[str, ...]) -> re.Pattern[str]:
+    """Compile an alternation of the tool names, longest first so that the longest name wins at a position"""
+    return re.compile("|".join(re.escape(tool_name) for tool_name in sorted(tool_names, key=len, reverse=True)))
+
+@lru_cache(maxsize=32)
+def _tool_automaton(tool_names: tuple[str, ...]) -> Any:
+    """Build an Aho-Corasick automaton over the tool names, or None without pyahocorasick"""
+    if ahocorasick is None or not tool_names:
+        return None
+    automaton = ahocorasick.Automaton()
+    for tool_name in tool_names:
+        automaton.add_word(tool_name, tool_name)
+    automaton.make_automaton()
+    return automaton
+
+def _find_tool_mention(response_text: str, tool_names: tuple[str, ...]) -> tuple[str, int] | None:
+    """Return the first tool named in response_text and the offset just after its name"""
+    if not tool_names:
+        return None
+    # The regex alternation is faster until the tool set gets large
+    automaton = _tool_automaton(tool_names) if len(tool_names) >= _AHOCORASICK_MIN_TOOLS else None
+    if automaton is not None:
+        for end_index, tool_name in automaton.iter_long(response_text):
+            return tool_name, end_index + 1
+        return None
+    match = _tool_pattern(tool_names).search(response_text)
+    if match:
+        return match.group(), match.end()
+    return None
+
+def _extract_launch_browser(params_text: str, response_text: str, session_id: str | None) -> Dict[str, Any] | None:
+    if "url" in params_text.lower():
+        url_match = _URL_RE.search(params_text)
+        if url_match:
+            return {"url": url_match.group(0)}
+    return None
+
+def _extract_click_element(params_text: str, response_text: str, session_id: str | None) -> Dict[str, Any] | None:
+    lowered = params_text.lower()
+    if "x" in lowered and "y" in lowered:
+        pattern_match = _XY_RE.search(params_text)
+        if pattern_match:
+            return {"x": pattern_match.group(1), "y": pattern_match.group(2)}
+    elif "coordinates" in lowered:
+        digits = _DIGITS_RE.findall(params_text)
+        if len(digits) >= 2:
+            return {"x": digits[0], "y": digits[1]}
+    return None
+
+def _extract_click_selector(params_text: str, response_text: str, session_id: str | None) -> Dict[str, Any] | None:
+    if "selector" in params_text.lower():
+        pattern_match = _SELECTOR_RE.search(params_text)
+        if pattern_match:
+            return {"selector": pattern_match.group(0).strip('"')}
+    return None
+
+def _extract_type_text(params_text: str, response_text: str, session_id: str | None) -> Dict[str, Any] | None:
+    if '"text"' not in params_text.lower():
+        return None
+    # The text is taken from the first fenced JSON object of the whole response
+    json_match = _JSON_FENCE_OBJECT_RE.search(response_text)
+    if json_match is None:
+        return None
+    action = _loads(json_match.group()+'}}')
+    logger.debug("Parsed type_text action: %s", action)
+    if "arguments" in action:
+        return action["arguments"]
+    elif "parameters" in action:
+        return action["parameters"]
+    elif "inputSchema" in action:
+        return action["inputSchema"]
+    return None
+
+def _extract_scroll_page(params_text: str, response_text: str, session_id: str | None) -> Dict[str, Any] | None:
+    if "direction" in params_text.lower():
+        pattern_match = _DIRECTION_RE.search(params_text)
+        if pattern_match:
+            return {"direction": pattern_match.group(0).strip('"')}
+    return None
+
+def _extract_get_dom_structure(params_text: str, response_text: str, session_id: str | None) -> Dict[str, Any] | None:
+    return {"max_depth": 3, "session_id": session_id}
+
+def _extract_data_pattern(params_text: str, response_text: str, session_id: str | None) -> Dict[str, Any] | None:
+    pattern_match = _EXTRACT_RE.search(params_text)
+    if pattern_match:
+        return {"pattern": pattern_match.group(0)}
+    return None
+
+def _extract_session_only(params_text: str, response_text: str, session_id: str | None) -> Dict[str, Any] | None:
+    return {"session_id": session_id}
+
+# Heuristic parameter extractors for the text fallback, keyed by tool name.
+# Each takes the text after the tool name, the whole response and the session ID.
+_PARAMS_EXTRACTORS: Dict[str, Callable[[str, str, str | None], Dict[str, Any] | None]] = {
+    "launch_browser": _extract_launch_browser,
+    "click_element": _extract_click_element,
+    "click_selector": _extract_click_selector,
+    "type_text": _extract_type_text,
+    "scroll_page": _extract_scroll_page,
+    "get_dom_structure": _extract_get_dom_structure,
+    "extract_data": _extract_data_pattern,
+    "take_screenshot": _extract_session_only,
+    "get_page_content": _extract_session_only,
+}
+
+def _parse_block(response_text: str, index: int, kind: str) -> Dict[str, Any] | None:
+    """Parse the action block of the given kind that starts at index"""
+    if kind == "json":
+        start = index + len("```json")
+        end = response_text.find("```", start)
+        if end == -1:
+            return None
+        action = _loads(response_text[start:end])
+        if isinstance(action, dict) and isinstance(action.get("steps"), list):
+            steps = [_normalize_action(step) for step in action["steps"]]
+            return {"steps": steps} if steps and all(steps) else None
+        return _normalize_action(action)
+    if kind == "python":
+        return _parse_python_call(response_text, index + len("```python"))
+    action, _ = _JSON_DECODER.raw_decode(response_text, index)
+    if isinstance(action, dict) and "tool" in action and "parameters" in action:
+        return action
+    return None
+
+def _parse_action(response_text: str, tool_names: tuple[str, ...], session_id: str | None) -> Dict[str, Any] | None:
+    """Extract an action from Ollama's response text, see MCPClient._parse_next_action"""
+    # Try the blocks in the order they appear, falling back to the next one if a block is unusable
+    for index, kind in _scan(response_text):
+        try:
+            action = _parse_block(response_text, index, kind)
+        except json.JSONDecodeError:
+            logger.debug("Response contained malformed JSON")
+            continue
+        if action:
+            return action
+
+    try:
+        mention = _find_tool_mention(response_text, tool_names)
+        if mention:
+            # Try to extract parameters from the text
+            tool_name, params_start = mention
+            params_text = response_text[params_start:].strip()
+
+            if tool_name != "launch_browser" and not session_id:
+                return None
+                    
+            # Simple heuristics to extract parameters, one per tool
+            extractor = _PARAMS_EXTRACTORS.get(tool_name)
+            parameters = extractor(params_text, response_text, session_id) if extractor else None
+            if parameters is not None:
+                return {"tool": tool_name, "parameters": parameters}
+
+        # If task completion is mentioned
+        lowered = response_text.casefold()
+        if "task complete" in lowered or "task is complete" in lowered:
+            return {"tool": "task_complete", "parameters": {}}
+            
+        return None
+        
+    except Exception as e:
+        logger.warning(f"Failed to parse next action: {e}")
+        return None
+
+
+@lru_cache(maxsize=256)
+def _parse_cached(response_text: str, tool_names: tuple[str, ...], session_id: str | None) -> tuple[tuple[str, tuple[tuple[str, Any], ...]], ...] | None:
+    """Memoized _parse_action returning an immutable (tool, parameter items) pair per step"""
+    action = _parse_action(response_text, tool_names, session_id)
+    if action is None:
+        return None
+    steps = action.get("steps") or [action]
+    if not all(isinstance(step.get("parameters"), dict) for step in steps):
+        return None
+    return tuple((step["tool"], tuple(step["parameters"].items())) for step in steps)
+
 
 class MCPClient:
     def __init__(self,server_url: str, transport_type: str, initial_task: str):
@@ -30,28 +391,48 @@ class MCPClient:
         self.task = initial_task
         
         # Get Ollama model from environment variable or use default
-        ollama_model = os.environ.get("OLLAMA_MODEL", "qwen2.5-coder:7b")
+        ollama_model = os.environ.get("OLLAMA_MODEL", "qwen2.5-coder:7b-instruct-q4_K_M")
         logger.info(f"Using Ollama model: {ollama_model}")
         
         # Configure Ollama with optimized parameters
         self.llm = ChatOllama(
             model=ollama_model,
             validate_model_on_init=True,
-            temperature=0.8,
-            num_ctx=32000,  # Large context window for complex tasks
+            temperature=float(os.environ.get("OLLAMA_TEMPERATURE", "0.8")),
+            num_ctx=int(os.environ.get("OLLAMA_NUM_CTX", "8192")),  # Context window, raise for long tasks
+            num_predict=int(os.environ.get("OLLAMA_NUM_PREDICT", "512")),  # Cap on tokens generated per turn
+            mirostat=0,
+            keep_alive="30m",  # Keep the model loaded between turns
             base_url="http://localhost:11434",
         )
+        # Seconds to wait for a reply before it is retried once
+        self.llm_timeout = float(os.environ.get("OLLAMA_TIMEOUT", "120"))
+        self._tools_by_name: Dict[str, Any] = {}
+        self._tool_names: tuple[str, ...] = ()
+        # Replies keyed by a hash of the prompt; only kept when sampling is deterministic
+        self._llm_cache: OrderedDict[bytes, AIMessageChunk] | None = OrderedDict() if self.llm.temperature == 0 else None
+        # Model with the MCP tools bound for native tool calling, set once the tools are listed
+        self.llm_with_tools = self.llm
+        # Open screenshots in the system image viewer as they are taken
+        self.show_screenshots = os.environ.get("MCP_SHOW_SCREENSHOTS", "").lower() in ("1", "true", "yes")
+        # Tools whose results need special handling; any other tool goes to _handle_default
+        self._handlers: Dict[str, Callable[[str, Dict[str, Any], str | None], Awaitable[tuple[str, str | None]]]] = {
+            "launch_browser": self._handle_launch_browser,
+            "take_screenshot": self._handle_screenshot,
+        }
         
-        # Initialize conversation history for continuous context
-        self.messages:list[SystemMessage|HumanMessage|AIMessage] = [
-            SystemMessage(content="""Use the browser automation tools and open required websites for extracting relevant information, and execute tasks.
-            Every step need to be well thought out and decide on the next procedure to be taken to execute the task.
-            """)
-        ]
-        
-        # Cache for storing frequently accessed data
-        self.cache = {}
-    
+        # Conversation history for continuous context. The system prompt is built
+        # once the tool list is known and is never rewritten afterwards, so that
+        # Ollama can reuse its prefix cache across turns.
+        self.messages:list[SystemMessage|HumanMessage|AIMessage|ToolMessage] = []
+        # Recent messages kept when the history is trimmed, and how many more may accumulate
+        # before the next trim; in between, the prompt prefix stays unchanged for Ollama's cache
+        self.max_recent = 2 * int(os.environ.get("MCP_HISTORY_WINDOW", "20"))
+        self.cache_buffer = int(os.environ.get("MCP_HISTORY_BUFFER", "10"))
+        # Running estimate of the history size, leaving room in the context for the reply
+        self._approx_tokens = 0
+        self._token_budget = self.llm.num_ctx - self.llm.num_predict # type: ignore
+
     async def connect(self):
         """Connect to the MCP server."""
         print(f"🔗 Attempting to connect to {self.server_url}...") 
@@ -60,8 +441,12 @@ class MCPClient:
         async with streamablehttp_client(
             url=self.server_url,
             timeout=timedelta(seconds=60),
+            httpx_client_factory=_create_http_client,
         ) as (read_stream, write_stream, get_session_id):
-            await self._run_session(read_stream, write_stream, get_session_id)
+            try:
+                await self._run_session(read_stream, write_stream, get_session_id)
+            finally:
+                await self.cleanup()
 
     async def _run_session(self, read_stream, write_stream, get_session_id):
         async with ClientSession(read_stream, write_stream) as session:
@@ -73,18 +458,41 @@ class MCPClient:
                     print(f"Session ID: {session_id}")
 
             try:
-                response = await self.session.list_tools()
+                # Load the Ollama model while the tool list is being fetched
+                response, _ = await asyncio.gather(self.session.list_tools(), self._warm_up())
                 self.tools = response.tools
+                self._index_tools()
                 print("\nConnected to server with tools:", [tool.name for tool in self.tools])
                 
-                tools_info = "\n".join([f"- {tool.name}: {tool.description},'inputSchema':{tool.inputSchema}" for tool in self.tools])
-                self.messages[0] = SystemMessage(content=f"{self.messages[0].content}\n\nAvailable tools:\n{tools_info}")
+                system_prompt = self._system_prompt()
+                self.messages = []
+                self._approx_tokens = 0
+                self._append(SystemMessage(content=system_prompt))
+                tool_definitions = self._tool_definitions()
+                self.llm_with_tools = self.llm.bind_tools(tool_definitions)
+                # The bound tool definitions are sent with every request and take up context too
+                self._token_budget = self.llm.num_ctx - self.llm.num_predict - len(_dumps(tool_definitions)) // 4 # type: ignore
             
             except Exception as e:
                 logger.error(f"Error listing tools: {str(e)}", exc_info=True)
                 raise
             await self.interactive_loop()
            
+    async def _warm_up(self):
+        """Send a tiny request so the Ollama model is resident before the first turn"""
+        try:
+            # A single generated token is enough; num_ctx and keep_alive stay the same
+            # so that Ollama does not reload the model for the first real turn
+            warm_up_llm = self.llm.model_copy(update={"num_predict": 1})
+            await asyncio.wait_for(
+                warm_up_llm.ainvoke([SystemMessage(content="."), HumanMessage(content="ready?")]),
+                self.llm_timeout,
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Ollama warmup did not finish within %g seconds, continuing", self.llm_timeout)
+        except Exception as e:
+            logger.warning(f"Ollama warmup failed: {str(e)}")
+
     async def cleanup(self):
         """Clean up resources"""
         logger.debug("Cleaning up resources")
@@ -93,84 +501,68 @@ class MCPClient:
     async def interactive_loop(self):
 
         # Add the initial task to the conversation
-        self.messages.append(HumanMessage(content=f"Task: {self.task}\n\nWhat should be my first step?"))
+        self._append(HumanMessage(content=f"Task: {self.task}\n\nWhat should be my first step?"))
 
         session_id = None
         task_complete = False
+        # One-shot messages sent after the history when the previous reply had no
+        # usable action; kept out of self.messages so the persisted prefix is stable.
+        retry: list[HumanMessage|AIMessage] = []
+        retries = 0
             
         while not task_complete:
             try:
                 # Get Ollama's next recommendation
-                print("\nSending current state to Ollama for analysis...")
-                response = await self.llm.ainvoke(self.messages)
-                print(f"\nOllama's analysis:\n{response.content}")
-
-              
-                # Add Ollama's response to the conversation history
-                self.messages.append(AIMessage(content=response.content))
-                
-                # Parse the recommended action
-                action = self._parse_next_action(str(response.content), session_id)
-                if not action:
+                logger.debug("Sending current state to Ollama for analysis...")
+                # A retry prompt repeats the unusable reply, so a cached answer would repeat it forever
+                try:
+                    response = await self._generate(self.messages + retry, use_cache=not retry)
+                except asyncio.TimeoutError:
+                    logger.error("Ollama timed out again, stopping")
+                    break
+                response_text: str = response.content # type: ignore
+                logger.info("Ollama's analysis:\n%s", response_text)
+            
+                # Use the native tool calls if there are any, otherwise parse the recommended actions
+                if response.tool_calls:
+                    steps = [_make_step(call["name"], call["args"], session_id) for call in response.tool_calls]
+                else:
+                    steps = self._parse_next_action(response_text, session_id)
+                if not steps:
+                    retries += 1
+                    if retries > MAX_RETRIES:
+                        logger.error("No usable action after %d retries, stopping", MAX_RETRIES)
+                        break
                     # Ask for a more specific action
-                    self.messages.append(HumanMessage(content="Please provide a specific action to take using one of the available tools. Format your response as a JSON object with 'tool' and 'parameters' fields."))
+                    retry = [AIMessage(content=response_text), HumanMessage(content=RETRY_PROMPT)]
                     continue
-                
+                retry = []
+                retries = 0
+
+                # Add Ollama's response to the conversation history
+                self._append(AIMessage(content=response_text, tool_calls=response.tool_calls))
+            
+                tool_steps = [step for step in steps if step["tool"] != "task_complete"]
+                finished = len(tool_steps) < len(steps)
+
+                if tool_steps:
+                    results, session_id = await self._run_steps(tool_steps, session_id)
+                    result_text = "\n".join(results)
+
                 # Check if the task is complete
-                if action.get("tool") == "task_complete":
+                if finished:
                     print("\nTask completed successfully!")
                     task_complete = True
                     break
-                
-                # Execute the recommended action
-                tool_name = action["tool"]
-                parameters = action["parameters"]
-                
-                # Handle session ID for browser actions
-                if tool_name == "launch_browser" and self.session:
-                    print(f"\nExecuting: {tool_name}")
-                    print(f"Parameters: {json.dumps(parameters, indent=2)}")
-                    
-                    result = await self.session.call_tool(tool_name, parameters)
-                    result_text = f"session_id: {result.content[0].text}" # type: ignore
-                    print(f"Result: {result_text}")
-                    
-                    # Store the session ID
-                    session_id = result.content[0].text # type: ignore
-                elif tool_name == "take_screenshot" and self.session:
-                    print(f"\nExecuting: {tool_name}")
-                    print(f"Parameters: {json.dumps(parameters, indent=2)}")
-                    
-                    result = await self.session.call_tool(tool_name, parameters)
-                    resultImage:list[ImageContent] = result.content[0] # type: ignore
-                    result_text = f"Screenshot captured ({len(resultImage.data)} bytes). File processed and cleaned up for security." # type: ignore
-                    encoded_data = resultImage.data # type: ignore
-                    decoded_image_data = base64.b64decode(encoded_data)
-                    image_stream = BytesIO(decoded_image_data)
-                    image = Image.open(image_stream)
-                    image.show()          
-                    result_text = f"Screenshot saved. The browser window shows the current state of the page."
-                elif session_id and self.session:
-                    # Update the session ID in the parameters
-                    parameters["session_id"] = session_id
-                    
-                    print(f"\nExecuting: {tool_name}")
-                    print(f"Parameters: {json.dumps(parameters, indent=2)}")
-                    
-                    result = await self.session.call_tool(tool_name, parameters)
-                    result_text = result.content[0].text # type: ignore
-                    print(f"Result: {result_text}")
-
-                elif self.session:
-                    print(f"\nExecuting: {tool_name}")
-                    print(f"Parameters: {json.dumps(parameters, indent=2)}")
-                    
-                    result = await self.session.call_tool(tool_name, parameters)
-                    result_text = result.content[0].text # type: ignore
-                    print(f"Result: {result_text}")
-                
-                # Add the result to the conversation
-                self.messages.append(HumanMessage(content=f"Action result: {result_text}\n\nWhat should be my next step?"))
+            
+                # Add the result to the conversation, answering native tool calls with their own messages
+                if response.tool_calls:
+                    call_ids = [call["id"] for call in response.tool_calls if call["name"] != "task_complete"]
+                    for call_id, result in zip(call_ids, results):
+                        self._append(ToolMessage(content=result, tool_call_id=call_id))
+                else:
+                    self._append(HumanMessage(content=f"Action result: {result_text}\n\nWhat should be my next step?"))
+                self._trim_history()
             except KeyboardInterrupt:
                 logger.info("\nTask execution interrupted by user.")
                 print("\n\n👋 Goodbye!")
@@ -180,161 +572,236 @@ class MCPClient:
             except Exception as e:
                 logger.error(f"Error during execution: {str(e)}", exc_info=True)
                 break
-            finally:
-                await self.cleanup()
 
-    def _parse_next_action(self, response_text: str, session_id:str | None) -> Dict[str, Any] | None:
-        """Parse the next action from Ollama's response
-        
-        Args:
-            response_text: Ollama's response text
-            
-        Returns:
-            Dictionary with tool name and parameters, or None if no valid action found
+    def _system_prompt(self) -> str:
+        """Return the system prompt listing the available tools
+
+        Only names and descriptions are listed; the parameter schemas reach Ollama
+        through the tools bound with bind_tools, so they are not sent twice.
         """
+        fingerprint = tuple((tool.name, tool.description or "") for tool in self.tools)
+        key = (self.server_url, fingerprint)
+        system_prompt = _SYSTEM_PROMPTS.get(key)
+        if system_prompt is None:
+            tools_info = "\n".join(f"- {name}: {description}" for name, description in fingerprint)
+            system_prompt = _SYSTEM_PROMPTS[key] = sys.intern(SYSTEM_PROMPT + "\n\nAvailable tools:\n" + tools_info)
+        return system_prompt
+
+    def _tool_definitions(self) -> list[Dict[str, Any]]:
+        """Describe the MCP tools in the function-calling format expected by bind_tools"""
+        definitions = [
+            {
+                "type": "function",
+                "function": {
+                    "name": tool.name,
+                    "description": tool.description or "",
+                    "parameters": tool.inputSchema,
+                },
+            }
+            for tool in self.tools
+        ]
+        definitions.append(TASK_COMPLETE_TOOL)
+        return definitions
+
+    async def _generate(self, messages: list[SystemMessage|HumanMessage|AIMessage|ToolMessage], use_cache: bool = True) -> AIMessageChunk:
+        """Return Ollama's reply, from the response cache when the same prompt was seen before"""
+        if self._llm_cache is None or not use_cache:
+            return await self._stream_with_timeout(messages)
+
+        serialized = _dumps([(type(message).__name__, message.content, getattr(message, "tool_calls", None)) for message in messages], default=str)
+        key = hashlib.blake2b(serialized, digest_size=16).digest()
+        response = self._llm_cache.get(key)
+        if response is not None:
+            self._llm_cache.move_to_end(key)
+            logger.debug("Reusing cached Ollama reply")
+            return response
+
+        response = await self._stream_with_timeout(messages)
+        self._llm_cache[key] = response
+        if len(self._llm_cache) > _LLM_CACHE_SIZE:
+            self._llm_cache.popitem(last=False)
+        return response
 
+    async def _stream_with_timeout(self, messages: list[SystemMessage|HumanMessage|AIMessage|ToolMessage]) -> AIMessageChunk:
+        """Stream Ollama's reply, retrying once after a short randomized pause if it times out
+
+        The retry asks for a shorter reply. If it also times out, asyncio.TimeoutError is raised.
+        """
         try:
-            import re
-            content = response_text.replace("\n", "")
-            if "json" in content:
-                json_matches = re.findall(r'(?<=```json).*?(?=```)', content)
-                action = json.loads(json_matches[0])
-                if isinstance(action, dict):
-                    if "name" in action and "arguments" in action:
-                        return {
-                            "tool":action["name"],
-                            "parameters":action["arguments"]
-                        }
-                    elif "tool" in action and "parameters" in action:
-                        return action
-                    elif "tool" in action and "inputSchema" in action:
-                        return {
-                            "tool":action["tool"],
-                            "parameters": action["inputSchema"]
-                        }
-            elif "python" in content:
-                json_matches = re.findall(r'(?<=python)(.+)\)', content)
-                firstTool = json_matches[0]
-                index = firstTool.find('(')
-                if index != -1:
-                    action = {}
-                    action["tool"] = firstTool[:index]
-                    paramSection = firstTool[index+1:]
-                    index = paramSection.find(')')
-                    if index != -1:
-                        paramSection = paramSection[:index]
-                    paramMatches = re.findall(r'([^,]+)=([^,]+)', paramSection)
-                    params = {}
-                    for p in paramMatches:
-                        params[p[0].strip()] = p[1].strip('\"\'')
-                    action["parameters"] = params
-                    return action
-            elif "parameters" in content or "url" in content:
-                action = json.loads(content)
-                if isinstance(action, dict) and "tool" in action and "parameters" in action:
-                    return action
-        except json.JSONDecodeError:
-            print()
+            return await asyncio.wait_for(self._stream_reply(messages), self.llm_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Ollama did not reply within %g seconds, retrying", self.llm_timeout)
+        await asyncio.sleep(1 + random.random())
+        return await asyncio.wait_for(self._stream_reply(messages + [HumanMessage(content=TIMEOUT_PROMPT)]), self.llm_timeout)
 
+    async def _stream_reply(self, messages: list[SystemMessage|HumanMessage|AIMessage|ToolMessage]) -> AIMessageChunk:
+        """Stream Ollama's reply, stopping as soon as a complete ```json block has arrived"""
+        chunks: list[AIMessageChunk] = []
+        text = ""
+        body_start = -1
+        stream = self.llm_with_tools.astream(messages)
         try:
-            if hasattr(self, 'tools'):
-                tool_names = [tool.name for tool in self.tools]
-                for tool_name in tool_names:
-                    if tool_name in response_text:
-                        # Try to extract parameters from the text
-                        params_start = response_text.find(tool_name) + len(tool_name)
-                        params_text = response_text[params_start:].strip()
-
-                        if tool_name != "launch_browser" and not session_id:
-                            return None
-                        
-                        # Simple heuristic to extract parameters
-                        parameters = {}
-                        if "url" in params_text.lower() and tool_name == "launch_browser":
-                            url_match = re.search(r'https?://[^\s"\']+', params_text)
-                            if url_match:
-                                parameters["url"] = url_match.group(0)
-                                return {"tool": tool_name, "parameters": parameters}
-                        elif tool_name == "click_element":
-                            if "x" in params_text.lower() and "y" in params_text.lower():
-                                pattern_match = re.search(r'x":\s*([^,]*),.*\s*?"y":\s*([^,]*)', params_text)                          
-                                if pattern_match:
-                                    parameters["x"] = pattern_match.group(1)
-                                    parameters["y"] = pattern_match.group(2)
-                                    return {"tool": tool_name, "parameters": parameters}
-                            elif "coordinates" in params_text.lower():
-                                pattern_match = re.findall(r'\d+', params_text)                                  
-                                if pattern_match:
-                                    parameters["x"] = pattern_match[0]
-                                    parameters["y"] = pattern_match[1]
-                                    return {"tool": tool_name, "parameters": parameters}
-                        elif tool_name == "click_selector" and  "selector" in params_text.lower():
-                            pattern_match = re.search(r'(?<="selector": )\".+\"', params_text)                          
-                            if pattern_match:
-                                parameters["selector"] = pattern_match.group(0).strip('"')
-                                return {"tool": tool_name, "parameters": parameters}
-                        elif tool_name == "type_text" and '"text"' in params_text.lower():
-                            content = response_text.replace("\n", "")
-                            json_pattern = r'(?<=```json).*?(?=})'
-                            json_matches = re.findall(json_pattern, content)
-                            action = json.loads(json_matches[0]+'}}')
-                            print(action)
-                            if "arguments" in action:
-                                return {
-                                    "tool":tool_name,
-                                    "parameters":action["arguments"]
-                                }
-                            elif "parameters" in action:
-                                return action
-                            elif "inputSchema" in action:
-                                return {
-                                    "tool":tool_name,
-                                    "parameters": action["inputSchema"]
-                                }
-                        elif tool_name == "scroll_page" and "direction" in params_text.lower():
-                            pattern_match = re.search(r'(?<="direction": )\".+\"', params_text)                          
-                            if pattern_match:
-                                parameters["direction"] = pattern_match.group(0).strip('"')
-                                return {"tool": tool_name, "parameters": parameters}
-                        elif tool_name == "get_dom_structure":
-                            parameters["max_depth"] = 3
-                            parameters["session_id"] = session_id
-                            return {"tool": tool_name, "parameters": parameters}
-                        elif tool_name == "extract_data":
-                            pattern_match = re.search(r'(?:)\[[\S\s]*\]', params_text)
-                            if pattern_match:
-                                parameters["pattern"] = pattern_match.group(0)
-                                return {"tool": tool_name, "parameters": parameters}                       
-                        elif tool_name == "take_screenshot" \
-                            or tool_name == "get_page_content" :
-                            parameters["session_id"] = session_id
-                            return {"tool": tool_name, "parameters": parameters}
+            async for chunk in stream:
+                chunks.append(chunk) # type: ignore
+                previous = len(text)
+                text += chunk.content # type: ignore
+                # Only the new text, plus enough overlap for a fence split across chunks, is searched
+                if body_start == -1:
+                    start = text.find("```json", max(0, previous - len("```json") + 1))
+                    if start == -1:
+                        continue
+                    body_start = start + len("```json")
+                if text.find("```", max(body_start, previous - 2)) != -1:
+                    break
+        finally:
+            # Closing the stream early stops Ollama from generating the rest of the reply
+            await stream.aclose()
+        if not chunks:
+            return AIMessageChunk(content="")
+        return chunks[0] + chunks[1:]
 
-            
-            # If task completion is mentioned
-            if "task complete" in response_text.lower() or "task is complete" in response_text.lower():
-                return {"tool": "task_complete", "parameters": {}}
-                
+    async def _run_steps(self, steps: list[Dict[str, Any]], session_id: str | None) -> tuple[list[str], str | None]:
+        """Run the steps of a plan and return their result texts, in order, and the session ID
+
+        Steps act on the same browser session, so they run in order. Only
+        consecutive calls to tools the server marks as read-only run
+        concurrently, and identical ones are only sent once and share their result.
+        """
+        plan_session_id = session_id
+        results = []
+        index = 0
+        while index < len(steps):
+            if session_id != plan_session_id:
+                # A browser was launched earlier in this plan, act on its session
+                steps = steps[:index] + [_make_step(step["tool"], step["parameters"], session_id) for step in steps[index:]]
+                plan_session_id = session_id
+            end = index
+            while end < len(steps) and self._call_key(steps[end]) is not None:
+                end += 1
+            if end - index > 1:
+                results.extend(await self._run_read_only(steps[index:end], session_id))
+                index = end
+                continue
+            step = steps[index]
+            text, session_id = await self._run_action(step["tool"], step["parameters"], session_id)
+            results.append(text)
+            index += 1
+        return results, session_id
+
+    async def _run_read_only(self, steps: list[Dict[str, Any]], session_id: str | None) -> list[str]:
+        """Run calls to read-only tools concurrently and return their result texts in order"""
+        calls: Dict[tuple[str, bytes], Awaitable[tuple[str, str | None]]] = {}
+        keys = [self._call_key(step) for step in steps]
+        for step, key in zip(steps, keys):
+            if key not in calls:
+                calls[key] = self._run_action(step["tool"], step["parameters"], session_id) # type: ignore
+        outcomes = dict(zip(calls, await asyncio.gather(*calls.values(), return_exceptions=True)))
+        # Only tool errors become results; a cancellation must still stop the turn
+        for outcome in outcomes.values():
+            if isinstance(outcome, BaseException) and not isinstance(outcome, Exception):
+                raise outcome
+        # A failing step is reported to Ollama instead of discarding the other results
+        return [
+            f"{step['tool']} failed: {outcomes[key]}" if isinstance(outcomes[key], Exception) else outcomes[key][0] # type: ignore
+            for step, key in zip(steps, keys)
+        ]
+
+    def _call_key(self, step: Dict[str, Any]) -> tuple[str, bytes] | None:
+        """Identify a call to a tool the server marks as read-only, None for any other tool"""
+        tool = self._tools_by_name.get(step["tool"])
+        if tool is None or tool.annotations is None or not tool.annotations.readOnlyHint:
             return None
+        return step["tool"], _dumps(step["parameters"], sort_keys=True)
+
+    async def _run_action(self, tool_name: str, parameters: Dict[str, Any], session_id: str | None) -> tuple[str, str | None]:
+        """Execute one action and return its result text and the (possibly new) session ID"""
+        logger.info("Executing: %s", tool_name)
+        logger.debug("Parameters: %s", _LazyJson(parameters))
+        handler = self._handlers.get(tool_name, self._handle_default)
+        return await handler(tool_name, parameters, session_id)
+
+    async def _handle_default(self, tool_name: str, parameters: Dict[str, Any], session_id: str | None) -> tuple[str, str | None]:
+        """Call an MCP tool and return the text of its first content item"""
+        result = await self.session.call_tool(tool_name, parameters) # type: ignore
+        result_text: str = result.content[0].text # type: ignore
+        logger.debug("Result: %s", result_text)
+        return result_text, session_id
+
+    async def _handle_launch_browser(self, tool_name: str, parameters: Dict[str, Any], session_id: str | None) -> tuple[str, str | None]:
+        """Launch a browser; the tool returns the ID of its new session"""
+        session_id, _ = await self._handle_default(tool_name, parameters, session_id)
+        return f"session_id: {session_id}", session_id
+
+    async def _handle_screenshot(self, tool_name: str, parameters: Dict[str, Any], session_id: str | None) -> tuple[str, str | None]:
+        """Take a screenshot, displaying it when enabled"""
+        result = await self.session.call_tool(tool_name, parameters) # type: ignore
+        resultImage:list[ImageContent] = result.content[0] # type: ignore
+        encoded_data: str = resultImage.data # type: ignore
+        # The decoded size follows from the base64 length, no need to decode to log it
+        logger.info("Screenshot captured (%d bytes)", len(encoded_data) * 3 // 4 - encoded_data[-2:].count("="))
+        if self.show_screenshots:
+            # Decoding and spawning the viewer would otherwise stall the event loop
+            await asyncio.to_thread(_show_image, encoded_data)
+        return "Screenshot saved. The browser window shows the current state of the page.", session_id
+
+    def _append(self, message: SystemMessage|HumanMessage|AIMessage|ToolMessage):
+        """Add a message to the history and update the approximate token count"""
+        self.messages.append(message)
+        self._approx_tokens += _approx_token_count(message)
+
+    def _trim_history(self):
+        """Drop old exchanges once the history outgrows its window or token budget
+
+        The system prompt and the task are always kept. The history is cut back to
+        max_recent messages, and further to 3/4 of the token budget if needed, so
+        that several turns pass before the next trim.
+        """
+        if len(self.messages) <= 2 + self.max_recent + self.cache_buffer and self._approx_tokens <= self._token_budget:
+            return
+        # An exchange is one of Ollama's replies followed by its results, which are
+        # never separated so that tool results always follow their tool calls
+        last_reply = max(index for index, message in enumerate(self.messages) if isinstance(message, AIMessage))
+        cut = max(2, len(self.messages) - self.max_recent)
+        while cut < last_reply and not isinstance(self.messages[cut], AIMessage):
+            cut += 1
+        cut = min(cut, last_reply)
+        tokens = self._approx_tokens - sum(_approx_token_count(message) for message in self.messages[2:cut])
+        # Keep dropping whole exchanges while over the target, but never the latest one
+        target = self._token_budget * 3 // 4
+        while tokens > target and cut < last_reply:
+            tokens -= _approx_token_count(self.messages[cut])
+            cut += 1
+            while not isinstance(self.messages[cut], AIMessage):
+                tokens -= _approx_token_count(self.messages[cut])
+                cut += 1
+        if cut > 2:
+            self.messages = self.messages[:2] + self.messages[cut:]
+            self._approx_tokens = tokens
+
+    def _index_tools(self):
+        """Index the tools by name; the names are also part of the parse cache key"""
+        self._tools_by_name = {tool.name: tool for tool in self.tools}
+        self._tool_names = tuple(self._tools_by_name)
+
+    def _parse_next_action(self, response_text: str, session_id:str | None) -> list[Dict[str, Any]] | None:
+        """Parse the next actions from Ollama's response
+        
+        Args:
+            response_text: Ollama's response text
+            session_id: Current browser session ID, if a browser has been launched
             
-        except Exception as e:
-            logger.warning(f"Failed to parse next action: {e}")
+        Returns:
+            List of dictionaries with tool name and parameters (a single action is a
+            one-element list), or None if no valid action found
+        """
+        parsed = _parse_cached(response_text, self._tool_names, session_id)
+        if parsed is None:
             return None
+        # Fresh dicts carrying the session ID, so the cached parameters are never modified
+        return [_make_step(tool_name, dict(parameters), session_id) for tool_name, parameters in parsed]
 
 
 async def main(): 
-#     import re
-#     response_text = '` tool to enter the search query and then simulate a click on the resulting link.\n   \n2. **Search and Click "HTML DOM API"**:\n   - Similarly, search for and click on the "HTML DOM API" section.\n\nLet\'s proceed with these steps:\n\n1. **Type Search Query for "Web APIs"**:\n   ```json\n   {\n     "tool": "type_text",\n     "inputSchema": {\n       "session_id": "cf4cf744576b53b20b0db4658915e3ff",\n       "text": "Web APIs"\n     }\n   }\n   ```\n\n2. **Click on the Resulting Link**:\n   - Assuming the search results are displayed and the first link is for "Web APIs", you can click it using its text content.\n   \n3. **Type Search Query for "HTML DOM API"**:\n   ```json\n   {\n     "tool": "type_text",\n     "inputSchema": {\n       "session_id": "cf4cf744576b53b20b0db4658915e3ff",\n       "text": "HTML DOM API"\n     }\n   }\n   ```\n\n4. **Click on the Resulting Link**:\n   - Similarly, click on the resulting link for "HTML DOM API".\n\nAfter these clicks, you should be on the HTML DOM API page. Now, you can extract its content using the `get_page_content` tool.\n\nHere is the command to get the page content:\n```json\n{\n  "tool": "get_page_content",\n  "inputSchema": {\n    "session_id": "cf4cf744576b53b20b0db4658915e3ff"\n  }\n}\n```\n\nProceed with these steps to navigate and extract the content from the MDN HTML DOM API page.'
-#     content = response_text.replace("\n", "")
-#  #   toolnameAndParamsMatch = re.search(r'(?<=python\\n).+\)', response_text)
-#     json_pattern = r'(?<=```json).*?(?=})'
-#     json_matches = re.findall(json_pattern, content)
-#     for t in json_matches:
-#         action = json.loads(t+'}}')
-#         print(action)
-#     toolnameAndParamsMatch = re.search(r'(?<=python\\n)(.+)\)', response_text)
-#     print(f"toolnameAndParamsMatch: {toolnameAndParamsMatch}")
-  
     server_url = 5600
     transport_type = "streamable-http"
     server_url = f"http://localhost:{server_url}/mcp"
@@ -355,4 +822,10 @@ async def main():
     await client.connect()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop
+    except ImportError:
+        # uvloop is optional and not available on Windows
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
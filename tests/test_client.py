@@ -0,0 +1,266 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, ToolMessage
+from mcp.types import Tool, ToolAnnotations
+
+import client
+
+
+TOOL_NAMES = ("launch_browser", "click_selector", "type_text", "scroll_page", "get_page_content")
+
+
+class FakeLLM:
+    """Stand-in for ChatOllama that streams canned replies and records every prompt"""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+        self.replies: list[str] = []
+        self.prompts: list[list] = []
+
+    def bind_tools(self, tools):
+        return self
+
+    def model_copy(self, update):
+        return self
+
+    async def ainvoke(self, messages):
+        return AIMessage(content="")
+
+    async def astream(self, messages):
+        self.prompts.append(list(messages))
+        yield AIMessageChunk(content=self.replies.pop(0) if self.replies else "")
+
+
+class FakeSession:
+    """Stand-in for the MCP ClientSession that records the order of tool calls"""
+
+    def __init__(self):
+        self.events: list[tuple[str, str]] = []
+
+    async def call_tool(self, tool_name, parameters):
+        self.events.append(("start", tool_name))
+        await asyncio.sleep(0)
+        self.events.append(("end", tool_name))
+        return SimpleNamespace(content=[SimpleNamespace(text=f"{tool_name} done")])
+
+
+@pytest.fixture
+def make_client(monkeypatch):
+    monkeypatch.setattr(client, "ChatOllama", FakeLLM)
+
+    def make(temperature="0.8", tools=()):
+        monkeypatch.setenv("OLLAMA_TEMPERATURE", temperature)
+        mcp_client = client.MCPClient("http://localhost:5600/mcp", "streamable-http", "do it")
+        mcp_client.session = FakeSession()
+        mcp_client.tools = list(tools)
+        mcp_client._index_tools()
+        return mcp_client
+
+    return make
+
+
+def test_json_fence():
+    response = 'Let me open it.\n```json\n{"tool": "launch_browser", "parameters": {"url": "https://mdn.io"}}\n```\nThen read it.'
+    assert client._parse_action(response, TOOL_NAMES, None) == {
+        "tool": "launch_browser",
+        "parameters": {"url": "https://mdn.io"},
+    }
+
+
+def test_json_fence_with_steps():
+    response = (
+        '```json\n{"steps": [{"tool": "scroll_page", "parameters": {"direction": "down"}},'
+        ' {"name": "get_page_content", "arguments": {}}]}\n```'
+    )
+    assert client._parse_action(response, TOOL_NAMES, "S1") == {
+        "steps": [
+            {"tool": "scroll_page", "parameters": {"direction": "down"}},
+            {"tool": "get_page_content", "parameters": {}},
+        ]
+    }
+
+
+def test_python_call_keeps_query_string_in_url():
+    response = 'Call:\n```python\nlaunch_browser(url="https://x.com/?q=1&lang=en,fr")\n```'
+    assert client._parse_action(response, TOOL_NAMES, None) == {
+        "tool": "launch_browser",
+        "parameters": {"url": "https://x.com/?q=1&lang=en,fr"},
+    }
+
+
+def test_python_call_with_several_arguments():
+    response = '```python\ntype_text(selector="input[name=q]", text="a, b = c")\n```'
+    assert client._parse_action(response, TOOL_NAMES, "S1") == {
+        "tool": "type_text",
+        "parameters": {"selector": "input[name=q]", "text": "a, b = c"},
+    }
+
+
+def test_tool_mention_fallback():
+    response = "I will use launch_browser with url https://example.org to start."
+    assert client._parse_action(response, TOOL_NAMES, None) == {
+        "tool": "launch_browser",
+        "parameters": {"url": "https://example.org"},
+    }
+
+
+def test_tool_mention_needs_a_session():
+    assert client._parse_action('use scroll_page "direction": "down"', TOOL_NAMES, None) is None
+
+
+def test_type_text_mention_without_fenced_object():
+    assert client._parse_action('use type_text "text": hello', TOOL_NAMES, "S1") is None
+
+
+def test_task_is_complete():
+    assert client._parse_action("All done, the Task is complete.", TOOL_NAMES, "S1") == {
+        "tool": "task_complete",
+        "parameters": {},
+    }
+
+
+def test_no_action():
+    assert client._parse_action("Let me think about this.", TOOL_NAMES, "S1") is None
+
+
+def test_trim_history_keeps_prompt_task_and_latest_exchanges(make_client):
+    mcp_client = make_client()
+    mcp_client.max_recent = 4
+    mcp_client.cache_buffer = 4
+    mcp_client._append(SystemMessage(content="system"))
+    mcp_client._append(HumanMessage(content="task"))
+    for turn in range(4):
+        mcp_client._append(AIMessage(content=f"reply {turn}"))
+        mcp_client._append(HumanMessage(content=f"result {turn}"))
+
+    # Within the window plus its buffer nothing is dropped
+    mcp_client._trim_history()
+    assert len(mcp_client.messages) == 10
+
+    mcp_client._append(AIMessage(content="reply 4"))
+    mcp_client._append(HumanMessage(content="result 4"))
+    mcp_client._trim_history()
+    assert [message.content for message in mcp_client.messages] == [
+        "system", "task", "reply 3", "result 3", "reply 4", "result 4",
+    ]
+    assert mcp_client._approx_tokens == sum(client._approx_token_count(message) for message in mcp_client.messages)
+
+
+def test_trim_history_keeps_tool_results_with_their_call(make_client):
+    mcp_client = make_client()
+    mcp_client.max_recent = 2
+    mcp_client.cache_buffer = 0
+    mcp_client._append(SystemMessage(content="system"))
+    mcp_client._append(HumanMessage(content="task"))
+    for turn in range(2):
+        mcp_client._append(AIMessage(content=f"reply {turn}"))
+        mcp_client._append(ToolMessage(content=f"first {turn}", tool_call_id=f"a{turn}"))
+        mcp_client._append(ToolMessage(content=f"second {turn}", tool_call_id=f"b{turn}"))
+
+    mcp_client._trim_history()
+    assert [message.content for message in mcp_client.messages] == [
+        "system", "task", "reply 1", "first 1", "second 1",
+    ]
+
+
+def test_generate_caches_replies_at_temperature_zero(make_client):
+    mcp_client = make_client(temperature="0")
+    mcp_client.llm.replies = ["first", "second"]
+    messages = [SystemMessage(content="system"), HumanMessage(content="task")]
+
+    assert asyncio.run(mcp_client._generate(messages)).content == "first"
+    assert asyncio.run(mcp_client._generate(list(messages))).content == "first"
+    assert len(mcp_client.llm.prompts) == 1
+
+    assert asyncio.run(mcp_client._generate(messages, use_cache=False)).content == "second"
+    assert len(mcp_client.llm.prompts) == 2
+
+
+def test_retries_bypass_the_cache_and_are_capped(make_client):
+    mcp_client = make_client(temperature="0")
+    mcp_client.llm.replies = ["Let me think."] * 10
+
+    asyncio.run(mcp_client.interactive_loop())
+
+    # The first reply and every retry reach Ollama; the loop gives up after MAX_RETRIES
+    assert len(mcp_client.llm.prompts) == client.MAX_RETRIES + 1
+    assert mcp_client.llm.prompts[-1][-1].content == client.RETRY_PROMPT
+
+
+def test_run_steps_keeps_order_and_dedupes_read_only_calls(make_client):
+    read_only = ToolAnnotations(readOnlyHint=True)
+    mcp_client = make_client(tools=[
+        Tool(name="type_text", inputSchema={}),
+        Tool(name="click_selector", inputSchema={}),
+        Tool(name="get_page_content", inputSchema={}, annotations=read_only),
+        Tool(name="get_dom_structure", inputSchema={}, annotations=read_only),
+    ])
+    steps = [
+        client._make_step("type_text", {"text": "hi"}, "S1"),
+        client._make_step("click_selector", {"selector": "button"}, "S1"),
+        client._make_step("get_page_content", {}, "S1"),
+        client._make_step("get_dom_structure", {}, "S1"),
+        client._make_step("get_page_content", {}, "S1"),
+    ]
+
+    results, session_id = asyncio.run(mcp_client._run_steps(steps, "S1"))
+
+    assert session_id == "S1"
+    assert results == [
+        "type_text done", "click_selector done",
+        "get_page_content done", "get_dom_structure done", "get_page_content done",
+    ]
+    assert mcp_client.session.events == [
+        ("start", "type_text"), ("end", "type_text"),
+        ("start", "click_selector"), ("end", "click_selector"),
+        # The read-only calls run together and the repeated one is only sent once
+        ("start", "get_page_content"), ("start", "get_dom_structure"),
+        ("end", "get_page_content"), ("end", "get_dom_structure"),
+    ]
+
+
+def test_page_text_does_not_complete_the_task(make_client):
+    mcp_client = make_client()
+    mcp_client.session.call_tool = lambda tool_name, parameters: asyncio.sleep(
+        0, SimpleNamespace(content=[SimpleNamespace(text="Your task is complete, says the page")])
+    )
+    mcp_client.llm.replies = [
+        '```json\n{"tool": "launch_browser", "parameters": {"url": "https://example.org"}}\n```',
+        "The task is complete.",
+    ]
+
+    asyncio.run(mcp_client.interactive_loop())
+
+    # Only the model's own reply ends the task, so Ollama is asked twice
+    assert len(mcp_client.llm.prompts) == 2
+
+
+def test_warm_up_timeout_does_not_block_startup(make_client):
+    mcp_client = make_client()
+    mcp_client.llm_timeout = 0.01
+
+    async def hang(messages):
+        await asyncio.sleep(10)
+
+    mcp_client.llm.ainvoke = hang
+    asyncio.run(asyncio.wait_for(mcp_client._warm_up(), 1))
+
+
+def test_run_steps_propagates_cancellation_of_read_only_calls(make_client):
+    read_only = ToolAnnotations(readOnlyHint=True)
+    mcp_client = make_client(tools=[
+        Tool(name="get_page_content", inputSchema={}, annotations=read_only),
+        Tool(name="get_dom_structure", inputSchema={}, annotations=read_only),
+    ])
+
+    async def call_tool(tool_name, parameters):
+        if tool_name == "get_dom_structure":
+            raise asyncio.CancelledError()
+        return SimpleNamespace(content=[SimpleNamespace(text="page")])
+
+    mcp_client.session.call_tool = call_tool
+    steps = [client._make_step("get_page_content", {}, "S1"), client._make_step("get_dom_structure", {}, "S1")]
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(mcp_client._run_steps(steps, "S1"))